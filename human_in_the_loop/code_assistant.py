@@ -8,6 +8,21 @@ export OPENAI_API_KEY="<your_openai_api_key>"
 export OPENAI_MODEL_NAME="<the_model_name>"
 ```
 
+Responses are cached in memory for one hour by default. You can optionally change the time-to-live (in seconds) of the cache:
+
+```shell
+export LLM_CACHE_TTL="3600"
+```
+
+To also reuse the responses of paraphrased requirements, set an embedding model to enable the semantic cache. The similarity threshold is optional:
+
+```shell
+export OPENAI_EMBEDDING_MODEL_NAME="text-embedding-3-small"
+export LLM_SEMANTIC_CACHE_THRESHOLD="0.92"
+```
+
+Responses are not cached if the sampling temperature is set above 0.2 by `OPENAI_TEMPERATURE`.
+
 Run this example with uv:
 
 ```shell
@@ -15,39 +30,329 @@ uv run human_in_the_loop/code_assistant.py
 ```
 """
 
+from __future__ import annotations
+
 import os
+import re
+import codecs
+import sys
+import time
+import asyncio
+import json
+import math
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 
 # Get the API base, API key and model name.
 _api_key = os.environ.get("OPENAI_API_KEY")
 _api_base = os.environ.get("OPENAI_API_BASE")
 _model_name = os.environ.get("OPENAI_MODEL_NAME")
+_temperature = float(os.environ["OPENAI_TEMPERATURE"]) if "OPENAI_TEMPERATURE" in os.environ else None
+# Get the time-to-live (in seconds) of the cached LLM responses.
+_cache_ttl = float(os.environ.get("LLM_CACHE_TTL", "3600"))
+# Get the embedding model name and the similarity threshold of the semantic cache.
+_embedding_model_name = os.environ.get("OPENAI_EMBEDDING_MODEL_NAME")
+_semantic_cache_threshold = float(os.environ.get("LLM_SEMANTIC_CACHE_THRESHOLD", "0.92"))
+
+# The limits of the process that runs the generated code: wall-clock seconds, CPU seconds and bytes of memory.
+_CODE_TIMEOUT = 30
+_CODE_CPU_LIMIT = 5
+_CODE_MEMORY_LIMIT = 512 * 1024 * 1024
+
+# Sampling with a high temperature is not deterministic, so its responses should not be reused.
+_MAX_CACHEABLE_TEMPERATURE = 0.2
 
 from pydantic import BaseModel, Field
+from pydantic_core import from_json
 from bridgic.core.automa import GraphAutoma, worker
 from bridgic.core.automa.args import From
 from bridgic.core.automa.interaction import Event, Feedback, FeedbackSender
 from bridgic.core.model.types import Message, Role
-from bridgic.core.model.protocols import PydanticModel
-from bridgic.llms.openai import OpenAILlm
 
-# Set the LLM
-llm = OpenAILlm(api_base=_api_base, api_key=_api_key, timeout=10)
+if TYPE_CHECKING:
+    import httpx
+    from bridgic.llms.openai import OpenAILlm
+
+# The LLM and its HTTP client are created on first use. Importing `bridgic.llms.openai` (and `openai` with it) takes much
+# longer than the rest of this module, so it is deferred until an LLM call is really needed, e.g. not on cache hits.
+_llm: Optional[OpenAILlm] = None
+_http_async_client: Optional[httpx.AsyncClient] = None
+
+def get_llm() -> OpenAILlm:
+    global _llm, _http_async_client
+    if _llm is None:
+        import httpx
+        from bridgic.llms.openai import OpenAILlm
+
+        # Set the HTTP client, whose connection pool keeps connections alive to be reused by the subsequent LLM calls.
+        # It is shared by all the requests of the process, but must only be used within the event loop that runs them.
+        # The pool timeout is short, so that an exhausted pool fails fast instead of queueing the requests.
+        _http_async_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=30),
+        )
+        timeout = httpx.Timeout(10, connect=2, write=5, pool=1)
+
+        # Set the LLM
+        _llm = OpenAILlm(api_base=_api_base, api_key=_api_key, timeout=timeout, http_async_client=_http_async_client)
+    return _llm
+
+# The system prompt is the first message of every request. Keep it unchanged, so that the prompt prefix can be reused by the
+# automatic prompt caching of OpenAI. Requests sharing the same `prompt_cache_key` are routed to the same prompt cache.
+# The `prompt_cache_key` parameter is specific to OpenAI, and may be rejected by other OpenAI-compatible endpoints, so it is
+# only sent when `OPENAI_API_BASE` is not set.
+SYSTEM_PROMPT = "You are a programming assistant. Please generate code according to the user's requirements."
+PROMPT_CACHE_KEY = "bridgic-code-assistant" if _api_base is None else None
 
 class CodeBlock(BaseModel):
     code: str = Field(description="The code to be executed.")
 
+# The response format and the system message are the same for every request, so build them only once.
+# Strict structured output of OpenAI requires `additionalProperties` to be false.
+_CODE_BLOCK_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "schema": {**CodeBlock.model_json_schema(), "additionalProperties": False},
+        "name": CodeBlock.__name__,
+        "strict": True,
+    },
+}
+_SYSTEM_MESSAGE = Message.from_text(text=SYSTEM_PROMPT, role=Role.SYSTEM)
+
+@lru_cache(maxsize=None)
+def code_block_schema() -> str:
+    return json.dumps(CodeBlock.model_json_schema(), sort_keys=True)
+
+class ResponseCache:
+    """
+    An in-memory LRU cache for LLM responses. Each entry expires after its time-to-live.
+    """
+    def __init__(self, maxsize: int = 128, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[str, Tuple[float, str]] = OrderedDict()
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        # Evict the least recently used entries.
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+def make_cache_key(user_requirement: str) -> str:
+    # Everything that affects the response is part of the key.
+    payload = json.dumps({
+        "model": _model_name,
+        "sys": SYSTEM_PROMPT,
+        "user": user_requirement,
+        "schema": code_block_schema(),
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+class SemanticCache:
+    """
+    An in-memory cache for LLM responses, which is looked up by the cosine similarity between the embeddings of the requests.
+    Each entry expires after its time-to-live.
+    """
+    def __init__(self, threshold: float = 0.92, maxsize: int = 128, ttl: float = 3600):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: List[Tuple[float, List[float], str]] = []
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> List[float]:
+        norm = math.sqrt(sum(x * x for x in embedding)) or 1.0
+        return [x / norm for x in embedding]
+
+    def get(self, embedding: List[float]) -> Optional[str]:
+        # Drop the expired entries.
+        now = time.monotonic()
+        self._entries = [entry for entry in self._entries if entry[0] >= now]
+        # Embeddings are stored normalized, so the dot product is the cosine similarity.
+        query = self._normalize(embedding)
+        best_score, best_value = -1.0, None
+        for _, vector, value in self._entries:
+            score = sum(a * b for a, b in zip(query, vector))
+            if score > best_score:
+                best_score, best_value = score, value
+        return best_value if best_score >= self.threshold else None
+
+    def set(self, embedding: List[float], value: str) -> None:
+        self._entries.append((time.monotonic() + self.ttl, self._normalize(embedding), value))
+        # Evict the oldest entries.
+        if len(self._entries) > self.maxsize:
+            del self._entries[:-self.maxsize]
+
+async def embed_text(text: str) -> List[float]:
+    response = await get_llm().async_client.embeddings.create(model=_embedding_model_name, input=text)
+    return response.data[0].embedding
+
+# The markdown fence around the code, if any. The whole opening line is consumed, whatever its info string is.
+_FENCE_RE = re.compile(r"\A\s*```[^\n]*\n(.*?)\n?```\s*\Z", re.DOTALL)
+
+def strip_code_fence(code: str) -> str:
+    match = _FENCE_RE.match(code)
+    return match.group(1) if match else code
+
+# The bootstrap of the process that runs the generated code. It limits the resources of its own process, and then runs the
+# code read from stdin. The `resource` module is only available on Unix.
+_RUN_CODE_BOOTSTRAP = """
+import sys
+try:
+    import resource
+except ImportError:
+    pass
+else:
+    cpu_limit, memory_limit = int(sys.argv[1]), int(sys.argv[2])
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, cpu_limit))
+    resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+code = sys.stdin.read()
+sys.argv = ["<assistant>"]
+exec(compile(code, "<assistant>", "exec"), {"__name__": "__main__"})
+"""
+
+async def run_code(code: str) -> Optional[int]:
+    """
+    Run the code in a separate Python process, so that neither a long-running code blocks the event loop nor a crash of it
+    affects the current process. The output is printed as it is produced. Return the exit code, or None if timed out.
+    """
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-c", _RUN_CODE_BOOTSTRAP, str(_CODE_CPU_LIMIT), str(_CODE_MEMORY_LIMIT),
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+    )
+
+    async def print_output():
+        try:
+            process.stdin.write(code.encode())
+            await process.stdin.drain()
+            process.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            # The process exited before reading the code, e.g. failed to start under the resource limits. Its output
+            # and exit code are still reported below.
+            pass
+        # Read the output in chunks rather than lines, since a line may be longer than the limit of the stream reader.
+        # The incremental decoder keeps the bytes of a character split between two chunks.
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        while chunk := await process.stdout.read(65536):
+            print(decoder.decode(chunk), end="", flush=True)
+        print(decoder.decode(b"", final=True), end="", flush=True)
+        return await process.wait()
+
+    try:
+        return await asyncio.wait_for(print_output(), timeout=_CODE_TIMEOUT)
+    except TimeoutError:
+        print(f"The code was killed since it did not finish in {_CODE_TIMEOUT} seconds.")
+        return None
+    finally:
+        # Kill the process if it is still running, e.g. timed out or cancelled, so that it is not left behind.
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+response_cache = ResponseCache(ttl=_cache_ttl)
+semantic_cache = SemanticCache(threshold=_semantic_cache_threshold, ttl=_cache_ttl) if _embedding_model_name else None
+cache_enabled = _temperature is None or _temperature <= _MAX_CACHEABLE_TEMPERATURE
+# The in-flight LLM calls, keyed by the cache key of their requests.
+_inflight_requests: Dict[str, asyncio.Task] = {}
+
+def _finish_inflight_request(cache_key: str, task: asyncio.Task) -> None:
+    if _inflight_requests.get(cache_key) is task:
+        del _inflight_requests[cache_key]
+    # Mark the exception as retrieved, in case all the requests waiting for it have been cancelled.
+    if not task.cancelled():
+        task.exception()
+
 class CodeAssistant(GraphAutoma):
     @worker(is_start=True)
     async def generate_code(self, user_requirement: str):
-        response = await llm.astructured_output(
+        if not cache_enabled:
+            response = await self.request_code_block(user_requirement)
+            return response.code
+
+        # The exact-match cache is the fast path.
+        cache_key = make_cache_key(user_requirement)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            code = CodeBlock.model_validate_json(cached).code
+            self.post_event(Event(event_type="code_token", data=code))
+            return code
+
+        # Concurrent requests with the same requirement share one in-flight call. The call runs in its own task, which every
+        # request awaits through a shield, so that cancelling one request does not cancel the call for the others.
+        task = _inflight_requests.get(cache_key)
+        if task is not None:
+            code = await asyncio.shield(task)
+            self.post_event(Event(event_type="code_token", data=code))
+            return code
+        task = asyncio.create_task(self.generate_code_on_cache_miss(user_requirement, cache_key))
+        _inflight_requests[cache_key] = task
+        task.add_done_callback(lambda t: _finish_inflight_request(cache_key, t))
+        return await asyncio.shield(task)
+
+    async def generate_code_on_cache_miss(self, user_requirement: str, cache_key: str) -> str:
+        embedding = None
+        if semantic_cache is not None:
+            try:
+                embedding = await embed_text(user_requirement)
+            except Exception as e:
+                # The semantic cache is optional, so fall back to the LLM call.
+                print(f"Failed to embed the requirement, the semantic cache is skipped. Error: {e}")
+        if embedding is not None:
+            cached = semantic_cache.get(embedding)
+            if cached is not None:
+                response_cache.set(cache_key, cached)
+                code = CodeBlock.model_validate_json(cached).code
+                self.post_event(Event(event_type="code_token", data=code))
+                return code
+
+        response = await self.request_code_block(user_requirement)
+        response_cache.set(cache_key, response.model_dump_json())
+        if embedding is not None:
+            semantic_cache.set(embedding, response.model_dump_json())
+        return response.code
+
+    async def request_code_block(self, user_requirement: str) -> CodeBlock:
+        # Stream the structured output, and post the code to the application layer piece by piece as it is generated.
+        content = ""
+        posted_code = ""
+        async for chunk in get_llm().astream(
             model=_model_name,
             messages=[
-                Message.from_text(text=f"You are a programming assistant. Please generate code according to the user's requirements.", role=Role.SYSTEM),
+                _SYSTEM_MESSAGE,
                 Message.from_text(text=user_requirement, role=Role.USER),
             ],
-            constraint=PydanticModel(model=CodeBlock)
-        )
-        return response.code
+            response_format=_CODE_BLOCK_RESPONSE_FORMAT,
+            temperature=_temperature,
+            # The parameter is left out of the request if it is None.
+            prompt_cache_key=PROMPT_CACHE_KEY,
+        ):
+            content += chunk.delta
+            try:
+                partial = from_json(content, allow_partial="trailing-strings")
+            except ValueError:
+                continue
+            code = partial.get("code", "") if isinstance(partial, dict) else ""
+            # The partial code may be shorter than the posted code when the content ends in an incomplete escape.
+            if len(code) > len(posted_code):
+                self.post_event(Event(event_type="code_token", data=code[len(posted_code):]))
+                posted_code = code
+        return CodeBlock.model_validate_json(content)
 
     @worker(dependencies=["generate_code"])
     async def ask_to_run_code(self, code: str):
@@ -57,32 +362,58 @@ class CodeAssistant(GraphAutoma):
         
     @worker(dependencies=["ask_to_run_code"])
     async def output_result(self, feedback: str, code: str = From("generate_code")):
-        code = code.strip("```python").strip("```")
+        code = strip_code_fence(code)
         if feedback == "yes":
             print(f"- - - - - - Result - - - - - -")
-            exec(code)
+            returncode = await run_code(code)
+            if returncode:
+                print(f"The code exited with code {returncode}.")
             print(f"- - - - - - End - - - - - -")
         else:
             print(f"This code was rejected for execution. In response to the requirements, I have generated the following code:\n```python\n{code}\n```")
 
-# Handle can_run_code event
-def can_run_code_handler(event: Event, feedback_sender: FeedbackSender):
-    print(f"Can I run this code now to verify if it's correct?")
-    print(f"```python\n{event.data}\n```")
-    res = input("Please input your answer (yes/no): ")
+# Keep references to the running handler tasks, so that they are not garbage collected before done.
+_handler_tasks = set()
+
+async def read_run_code_answer(feedback_sender: FeedbackSender):
+    # Wait for the user's input in a separate thread, so that the event loop is not blocked.
+    try:
+        res = await asyncio.to_thread(input, "Please input your answer (yes/no): ")
+    except Exception as e:
+        # Reject the code if no answer can be read, e.g. at the end of the input, so that the worker does not wait forever.
+        print(f"Failed to read the answer, the code will not be run. Error: {e!r}")
+        res = "no"
     if res in ["yes", "no"]:
         feedback_sender.send(Feedback(data=res))
     else:
         print("Invalid input. Please input yes or no.")
         feedback_sender.send(Feedback(data="no"))
 
-# register can_run_code event handler to `CodeAssistant` automa
+# Handle code_token event by printing the code as it is generated.
+def code_token_handler(event: Event):
+    print(event.data, end="", flush=True)
+
+# Handle can_run_code event
+# Note: Event handlers are plain functions called synchronously by Bridgic in the thread of the event loop. Awaitable work is scheduled as a task instead, which sends the feedback when done.
+def can_run_code_handler(event: Event, feedback_sender: FeedbackSender):
+    # The code has been printed by `code_token_handler`.
+    print(f"\n\nCan I run this code now to verify if it's correct?")
+    task = asyncio.create_task(read_run_code_answer(feedback_sender))
+    _handler_tasks.add(task)
+    task.add_done_callback(_handler_tasks.discard)
+
+# register code_token and can_run_code event handlers to `CodeAssistant` automa
 code_assistant = CodeAssistant()
+code_assistant.register_event_handler("code_token", code_token_handler)
 code_assistant.register_event_handler("can_run_code", can_run_code_handler)
 
 async def main():
-    await code_assistant.arun(user_requirement="Please write a function to print 'Hello, World!' and run it.")
+    try:
+        await code_assistant.arun(user_requirement="Please write a function to print 'Hello, World!' and run it.")
+    finally:
+        # Close the pooled connections.
+        if _http_async_client is not None:
+            await _http_async_client.aclose()
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(main())
\ No newline at end of file
@@ -9,13 +9,21 @@ uv run human_in_the_loop/reimbursement_automation.py
 """
 
 import os
+import gzip
+import mmap
+import uuid
+import zlib
+import atexit
+import shutil
+import asyncio
 import tempfile
 from httpx import delete
 from pydantic import BaseModel
 from datetime import datetime
+from typing import Callable, Dict, List, Set, Tuple
 from bridgic.core.automa import GraphAutoma, worker, Snapshot
 from bridgic.core.automa.args import From
-from bridgic.core.automa.interaction import Event, InteractionFeedback, InteractionException
+from bridgic.core.automa.interaction import Event, Interaction, InteractionFeedback, InteractionException
 
 class ReimbursementRecord(BaseModel):
     request_id: int
@@ -27,11 +35,105 @@ class ReimbursementRecord(BaseModel):
     created_at: datetime
     updated_at: datetime
 
+class ReimbursementPolicy(BaseModel):
+    max_amount_per_request: float
+    max_amount_per_month: float
+
+# The policy applied to the employees without a policy of their own.
+DEFAULT_POLICY = ReimbursementPolicy(max_amount_per_request=2500, max_amount_per_month=10000)
+
 class AuditResult(BaseModel):
     request_id: int
     passed: bool
     audit_reason: str
 
+# Each audit rule is a predicate that tells whether a record violates the rule, given the reimbursement policy, the other
+# records of the month and the `monthly_amount`, which is the total amount of the month with the record, together with the
+# template of the failure reason. The rules are checked in order. The templates are formatted with the `record`, the `policy`
+# and the `monthly_amount`.
+AuditRule = Tuple[Callable[[ReimbursementRecord, ReimbursementPolicy, List[ReimbursementRecord], float], bool], str]
+
+AUDIT_RULES: List[AuditRule] = [
+    (
+        lambda record, policy, monthly_records, monthly_amount: record.reimbursement_amount > policy.max_amount_per_request,
+        "The reimbursement amount {record.reimbursement_amount} exceeds the limit of {policy.max_amount_per_request}.",
+    ),
+    (
+        lambda record, policy, monthly_records, monthly_amount: monthly_amount > policy.max_amount_per_month,
+        "The total reimbursement amount {monthly_amount} of month {record.reimbursement_month} exceeds the limit of {policy.max_amount_per_month}.",
+    ),
+    (
+        lambda record, policy, monthly_records, monthly_amount: any(
+            r.reimbursement_amount == record.reimbursement_amount and r.description == record.description
+            for r in monthly_records
+        ),
+        "The reimbursement request duplicates a submitted request of the same month.",
+    ),
+    # TODO: Add more audit rules here.
+]
+
+async def query_records_from_database(request_ids: List[int]) -> Dict[int, ReimbursementRecord]:
+    # Simulate a bulk database query, like `SELECT ... WHERE request_id = ANY($1)`...
+    return {
+        request_id: ReimbursementRecord(
+            request_id=request_id,
+            employee_id=888888,
+            employee_name="John Doe",
+            reimbursement_month="2025-10",
+            reimbursement_amount=1024.00,
+            description="Hotel expenses for a business trip",
+            created_at=datetime(2025, 10, 11, 10, 0, 0),
+            updated_at=datetime(2025, 10, 11, 10, 0, 0)
+        )
+        for request_id in request_ids
+    }
+
+class RecordLoader:
+    """
+    The OA system may trigger many reimbursement workflows at the same time. The loader coalesces the records requested in
+    the same iteration of the event loop, and loads them with one bulk database query instead of one query per record.
+    """
+    def __init__(self):
+        self._pending: Dict[int, asyncio.Future] = {}
+        # Keep references to the running queries, so that they are not garbage collected before done.
+        self._tasks: Set[asyncio.Task] = set()
+
+    def load(self, request_id: int) -> asyncio.Future:
+        if request_id in self._pending:
+            return self._pending[request_id]
+        loop = asyncio.get_running_loop()
+        if not self._pending:
+            # Wait for the other loads requested in the current iteration of the event loop.
+            loop.call_soon(self._dispatch)
+        future = loop.create_future()
+        self._pending[request_id] = future
+        return future
+
+    def _dispatch(self) -> None:
+        pending, self._pending = self._pending, {}
+        task = asyncio.create_task(self._load_batch(pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _load_batch(self, pending: Dict[int, asyncio.Future]) -> None:
+        # The futures of the cancelled loads are done already, so they are skipped.
+        try:
+            records = await query_records_from_database(list(pending))
+        except Exception as e:
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for request_id, future in pending.items():
+            if future.done():
+                continue
+            if request_id in records:
+                future.set_result(records[request_id])
+            else:
+                future.set_exception(LookupError(f"The reimbursement record {request_id} is not found."))
+
+record_loader = RecordLoader()
+
 class ReimbursementWorkflow(GraphAutoma):
     @worker(is_start=True)
     async def load_record(self, request_id: int):
@@ -55,14 +157,34 @@ class ReimbursementWorkflow(GraphAutoma):
         - Duplicate submissions
         - Other non-compliant cases
         """
-        if record.reimbursement_amount > 2500:
+        # The policy and the other records of the month are independent, so load them concurrently.
+        policy, monthly_records = await asyncio.gather(
+            self.load_policy_from_database(record.employee_id),
+            self.load_monthly_records_from_database(record.employee_id, record.reimbursement_month),
+            return_exceptions=True,
+        )
+        # The request can not be audited without any of them, so the audit fails.
+        if isinstance(policy, Exception):
             return AuditResult(
                 request_id=record.request_id,
                 passed=False,
-                audit_reason="The reimbursement amount {record.reimbursement_amount} exceeds the limit of 2500."
+                audit_reason=f"Failed to load the reimbursement policy of employee {record.employee_id}. Error: {policy}"
             )
-        # TODO: Add more audit rules here.
-        ...
+        if isinstance(monthly_records, Exception):
+            return AuditResult(
+                request_id=record.request_id,
+                passed=False,
+                audit_reason=f"Failed to load the reimbursement records of month {record.reimbursement_month}. Error: {monthly_records}"
+            )
+
+        monthly_amount = record.reimbursement_amount + sum(r.reimbursement_amount for r in monthly_records)
+        for violates, reason in AUDIT_RULES:
+            if violates(record, policy, monthly_records, monthly_amount):
+                return AuditResult(
+                    request_id=record.request_id,
+                    passed=False,
+                    audit_reason=reason.format(record=record, policy=policy, monthly_amount=monthly_amount)
+                )
 
         return AuditResult(
             request_id=record.request_id,
@@ -95,36 +217,66 @@ class ReimbursementWorkflow(GraphAutoma):
         return False
 
     async def load_record_from_database(self, request_id: int):
+        # The record is loaded together with the records requested by the other running workflows. The future is shared by them,
+        # so it is shielded, in order not to cancel the loads of the others when the current workflow is cancelled.
+        return await asyncio.shield(record_loader.load(request_id))
+
+    async def load_policy_from_database(self, employee_id: int):
         # Simulate a database query...
-        return ReimbursementRecord(
-            request_id=request_id,
-            employee_id=888888,
-            employee_name="John Doe",
-            reimbursement_month="2025-10",
-            reimbursement_amount=1024.00,
-            description="Hotel expenses for a business trip",
-            created_at=datetime(2025, 10, 11, 10, 0, 0),
-            updated_at=datetime(2025, 10, 11, 10, 0, 0)
-        )
+        return DEFAULT_POLICY
+
+    async def load_monthly_records_from_database(self, employee_id: int, reimbursement_month: str) -> List[ReimbursementRecord]:
+        # Simulate a database query for the other reimbursement records submitted in the month...
+        return []
+
     async def lanuch_payment_transaction(self, request_id: int):
         # Simulate a payment execution...
         ...
 
 async def main():
+    # The approval UI posts the decisions of the manager to the queue, which are consumed to resume the paused workflows.
+    # In production, it can be a message queue such as Redis Streams or NATS, so that any worker process can resume them.
+    approval_queue: asyncio.Queue[InteractionFeedback] = asyncio.Queue()
+    # The snapshots of the paused workflows in the database, keyed by the interaction id.
+    paused_workflows: Dict[str, dict] = {}
+
     reimbursement_workflow = ReimbursementWorkflow()
     try:
         await reimbursement_workflow.arun(request_id=123456)
+        # The workflow finished without waiting for approval, e.g. the request failed the audit.
+        return
     except InteractionException as e:
         # The `ReimbursementWorkflow` instance has been paused and serialized to a snapshot.
-        interaction_id = e.interactions[0].interaction_id
-        record = e.interactions[0].event.data["reimbursement_record"]
+        interaction = e.interactions[0]
         # Save the snapshot to the database.
-        db_context = await save_snapshot_to_database(e.snapshot)
+        paused_workflows[interaction.interaction_id] = await save_snapshot_to_database(e.snapshot)
         print("The `ReimbursementWorkflow` instance has been paused and serialized to a snapshot.")
         print("The snapshot has been persisted to database.")
+    # The paused instance is not needed while waiting, since the workflow is resumed from the snapshot.
+    del reimbursement_workflow
 
+    approval_task = asyncio.create_task(request_approval_from_console(interaction, approval_queue))
     print("Waiting for the manager's approval (It may take long time) ...")
-    human_feedback = input(
+    # The event loop is free to run other workflows until the decision arrives.
+    # If the approval UI fails before posting a decision, nothing arrives on the queue, so stop waiting and raise its error.
+    get_task = asyncio.create_task(approval_queue.get())
+    await asyncio.wait({get_task, approval_task}, return_when=asyncio.FIRST_COMPLETED)
+    if not get_task.done():
+        get_task.cancel()
+        # Re-raise the exception of the approval task.
+        await approval_task
+        # The approval task returned without posting a decision.
+        return
+    feedback = get_task.result()
+    await resume_workflow(feedback, paused_workflows.pop(feedback.interaction_id))
+    await approval_task
+
+async def request_approval_from_console(interaction: Interaction, approval_queue: asyncio.Queue):
+    # Simulate the approval UI with a console prompt.
+    record = interaction.event.data["reimbursement_record"]
+    # Wait for the input in a separate thread, so that the event loop is not blocked.
+    human_feedback = await asyncio.to_thread(
+        input,
         "\n"
         "---------- Message to User ------------\n"
         "A reimbursement request has been submitted and audited by the system.\n"
@@ -136,53 +288,118 @@ async def main():
         "Otherwise, please input 'no' or the reason for rejection.\n"
         "Your input: "
         )
+    await approval_queue.put(InteractionFeedback(
+        interaction_id=interaction.interaction_id,
+        data=human_feedback
+    ))
 
+async def resume_workflow(feedback: InteractionFeedback, db_context: dict):
     # Load the snapshot from the database.
     snapshot = await load_snapshot_from_database(db_context)
-    # Deserialize the `ReimbursementWorkflow` instance from the snapshot.
+    # Deserialize the `ReimbursementWorkflow` instance from the snapshot. The instance is restored from the state in the snapshot
+    # directly, without calling `__init__()` again.
     reimbursement_workflow = ReimbursementWorkflow.load_from_snapshot(snapshot)
     print("-------------------------------------\n")
     print("The `ReimbursementWorkflow` instance has been deserialized and loaded from the snapshot. It will resume to run immediately...")
-    feedback = InteractionFeedback(
-        interaction_id=interaction_id,
-        data=human_feedback
-    )
     await reimbursement_workflow.arun(interaction_feedback=feedback)
+    # The snapshot is not needed anymore once the workflow has finished, so delete it to free the storage. It is kept if the
+    # workflow fails to resume, so that the approval can be retried.
+    await delete_snapshot_from_database(db_context)
+
+
+# The codec used to compress the serialized bytes of the snapshots. Bridgic serializes them with msgpack already, and fast
+# compression makes them smaller to store. The codec is stored alongside the serialization version, in order to read the
+# snapshots stored with different codecs.
+SNAPSHOT_CODEC = "gzip"
+
+def encode_snapshot_bytes(data: bytes, codec: str) -> bytes:
+    if codec == "gzip":
+        return gzip.compress(data, compresslevel=1)
+    if codec == "identity":
+        return data
+    raise ValueError(f"Unsupported snapshot codec: {codec}")
+
+# The size of the chunks in which the compressed snapshots are decompressed.
+_DECODE_CHUNK_SIZE = 1024 * 1024
 
+def decode_snapshot_bytes(data, codec: str) -> bytes:
+    # The data may be any bytes-like object, such as a memory-mapped file.
+    if codec == "gzip":
+        # Decompress chunk by chunk. `gzip.decompress()` would copy the whole data into memory first.
+        decompressor = zlib.decompressobj(wbits=31)
+        chunks = []
+        with memoryview(data) as view:
+            for start in range(0, len(view), _DECODE_CHUNK_SIZE):
+                chunks.append(decompressor.decompress(view[start:start + _DECODE_CHUNK_SIZE]))
+        chunks.append(decompressor.flush())
+        # Detect a corrupted snapshot, as `gzip.decompress()` does.
+        if not decompressor.eof:
+            raise EOFError("The snapshot ended before the end of its gzip stream.")
+        if decompressor.unused_data:
+            raise ValueError("The snapshot has trailing data after its gzip stream.")
+        return b"".join(chunks)
+    if codec == "identity":
+        return bytes(data)
+    raise ValueError(f"Unsupported snapshot codec: {codec}")
+
+# The temporary directory shared by all the snapshots stored by the process, which is removed when the process exits.
+SNAPSHOT_DIR = tempfile.mkdtemp(prefix="bridgic-snap-")
+atexit.register(shutil.rmtree, SNAPSHOT_DIR, ignore_errors=True)
 
 async def save_snapshot_to_database(snapshot: Snapshot):
     # Simulate a database storage using temporary files.
-    temp_dir = tempfile.TemporaryDirectory()
-    bytes_file = os.path.join(temp_dir.name, "reimbursement_workflow.bytes")
-    version_file = os.path.join(temp_dir.name, "reimbursement_workflow.version")
-    with open(bytes_file, "wb") as f:
-        f.write(snapshot.serialized_bytes)
-    with open(version_file, "w") as f:
-        f.write(snapshot.serialization_version)
+    snapshot_id = uuid.uuid4().hex
+    bytes_file = os.path.join(SNAPSHOT_DIR, f"{snapshot_id}.bytes")
+    version_file = os.path.join(SNAPSHOT_DIR, f"{snapshot_id}.version")
+    encoded_bytes = await asyncio.to_thread(encode_snapshot_bytes, snapshot.serialized_bytes, SNAPSHOT_CODEC)
+    # Write the files in worker threads concurrently, so that the event loop is not blocked by disk I/O.
+    await asyncio.gather(
+        asyncio.to_thread(write_file, bytes_file, "wb", encoded_bytes),
+        asyncio.to_thread(write_file, version_file, "w", f"{snapshot.serialization_version}\n{SNAPSHOT_CODEC}"),
+    )
 
     return {
         "bytes_file": bytes_file,
         "version_file": version_file,
-        "temp_dir": temp_dir,
     }
 
 async def load_snapshot_from_database(db_context):
     # Simulate a database query using temporary files.
     bytes_file = db_context["bytes_file"]
     version_file = db_context["version_file"]
-    temp_dir = db_context["temp_dir"]
 
-    with open(bytes_file, "rb") as f:
-        serialized_bytes = f.read()
-    with open(version_file, "r") as f:
-        serialization_version = f.read()
+    version_content = await asyncio.to_thread(read_file, version_file, "r")
+    # The snapshots stored without a codec are not compressed.
+    serialization_version, _, codec = version_content.partition("\n")
+    serialized_bytes = await asyncio.to_thread(read_snapshot_bytes, bytes_file, codec or "identity")
     snapshot = Snapshot(
         serialized_bytes=serialized_bytes, 
         serialization_version=serialization_version
     )
     return snapshot
 
+async def delete_snapshot_from_database(db_context):
+    # Simulate a database deletion by removing the temporary files.
+    await asyncio.gather(
+        asyncio.to_thread(os.remove, db_context["bytes_file"]),
+        asyncio.to_thread(os.remove, db_context["version_file"]),
+    )
+
+def write_file(path: str, mode: str, data):
+    with open(path, mode) as f:
+        f.write(data)
+
+def read_file(path: str, mode: str):
+    with open(path, mode) as f:
+        return f.read()
+
+def read_snapshot_bytes(path: str, codec: str) -> bytes:
+    # Decode the memory-mapped file instead of reading it into a bytes object first. The kernel pages the file in on demand,
+    # and the compressed bytes are decoded chunk by chunk without being copied into memory as a whole. The mapping is
+    # released once decoded.
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return decode_snapshot_bytes(mm, codec)
+
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(main())
 